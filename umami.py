@@ -1,33 +1,68 @@
 import streamlit as st
 import pandas as pd
-import itertools
-from chardet.universaldetector import UniversalDetector
+import numpy as np
+from io import BytesIO
+try:
+    import cchardet as chardet_mod  # C実装（faust-cchardet、インストールされていれば優先）
+except ImportError:
+    import chardet as chardet_mod
 
 # --- エンコーディング自動検出 ---
+DETECT_SAMPLE_SIZE = 64 * 1024  # 判定に使う先頭バイト数
+
 def detect_encoding(file_obj):
-    detector = UniversalDetector()
     file_obj.seek(0)
-    for line in file_obj:
-        detector.feed(line)
-        if detector.done:
-            break
-    detector.close()
+    head = file_obj.read(DETECT_SAMPLE_SIZE)
+    file_obj.seek(0)
+
+    # BOM付きはBOMで確定
+    if head.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    if head.startswith((b"\xff\xfe\x00\x00", b"\x00\x00\xfe\xff")):
+        return "utf-32"
+    if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return "utf-16"
+    # ASCIIのみならUTF-8として扱う（ASCIIの上位互換）
+    if head.isascii():
+        return "utf-8"
+
+    return chardet_mod.detect(head)['encoding']
+
+# --- CSV読み込み（pyarrowエンジン優先、失敗時はCエンジン） ---
+CSV_DTYPES = {"馬名": "string"}  # 型推論を省く既知カラム
+
+def read_csv_fast(file_obj, encoding, sep=","):
+    file_obj.seek(0)
+    try:
+        df = pd.read_csv(file_obj, encoding=encoding, sep=sep, dtype=CSV_DTYPES, engine="pyarrow")
+        # pandas 2.xのpyarrowエンジンは重複カラム名を「.1」付きに変換しないため、その場合はCエンジンで読み直す
+        if df.columns.is_unique:
+            return df
+    except (ImportError, ValueError):  # pyarrow未導入 / ArrowInvalid
+        pass
     file_obj.seek(0)
-    return detector.result['encoding']
+    return pd.read_csv(file_obj, encoding=encoding, sep=sep, dtype=CSV_DTYPES, engine="c")
 
-# --- 安全なCSV読み込み ---
+# --- 安全なCSV読み込み（カンマ区切り → 失敗時はタブ区切り） ---
 def safe_read_csv(file_obj):
     encoding = detect_encoding(file_obj)
     try:
-        return pd.read_csv(file_obj, encoding=encoding)
-    except Exception:
-        file_obj.seek(0)
-        return pd.read_csv(file_obj, encoding=encoding, sep="\t")
-
-# --- 正規化ユーティリティ ---
-def normalize(series):
-    total = series.sum()
-    return series / total if total > 0 else series
+        return read_csv_fast(file_obj, encoding)
+    except pd.errors.ParserError:
+        return read_csv_fast(file_obj, encoding, sep="\t")
+
+# --- アップロード内容ごとにキャッシュした読み込み ---
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_csv(file_bytes: bytes) -> pd.DataFrame:
+    return safe_read_csv(BytesIO(file_bytes))
+
+# --- 総合スコアと確率の算出 ---
+def fuse_scores(pop, rate, corr):
+    score = pop * 0.5 + rate * 0.3 + corr * 0.2
+    score[~np.isfinite(score)] = 0.0  # 念のためのガード（合計がNaNにならないように）
+    total = score.sum()
+    prob = score / total if total > 0 else score
+    return score, prob
 
 # --- Streamlit UI ---
 st.title("競馬馬券 期待値比較アプリ")
@@ -51,8 +86,8 @@ st.markdown("⚠️ **血統アプリから出力したCSVは、1行目などに
 
 if race_file and rate_file:
     try:
-        race_df = safe_read_csv(race_file)
-        rate_df = safe_read_csv(rate_file)
+        race_df = load_csv(race_file.getvalue())
+        rate_df = load_csv(rate_file.getvalue())
     except Exception as e:
         st.error(f"CSVの読み込みに失敗しました：{e}")
         st.stop()
@@ -66,11 +101,15 @@ if race_file and rate_file:
     race_df["単勝オッズ"] = pd.to_numeric(race_df[odds_col], errors="coerce")
 
     df = race_df.copy()
-    rate_map = rate_df.set_index("馬名")["複勝率"].to_dict()
+    rate_df["複勝率"] = pd.to_numeric(rate_df["複勝率"], errors="coerce")
+    rate_map = dict(zip(rate_df["馬名"].to_numpy(), rate_df["複勝率"].to_numpy()))
 
-    df["人気スコア"] = 1 / df["単勝オッズ"]
-    df["複勝率スコア"] = df["馬名"].map(rate_map)
-    df["複勝率スコア"] = pd.to_numeric(df["複勝率スコア"], errors="coerce").fillna(0.0)
+    # オッズが0・欠損の馬は人気スコア0とする
+    odds = df["単勝オッズ"].to_numpy(dtype=np.float64)
+    pop = np.zeros_like(odds)
+    np.reciprocal(odds, out=pop, where=odds > 0)
+    df["人気スコア"] = pop
+    df["複勝率スコア"] = df["馬名"].map(rate_map).fillna(0.0)
 
     # 補正項目表形式UI
     st.subheader("③ 各馬の補正項目（横並び・±0.05刻み）")
@@ -82,30 +121,49 @@ if race_file and rate_file:
     }
 
     corrections = {f + "補正": [] for f in correction_fields}
-    st.markdown("### 補正入力表")
-    header = st.columns([1] + [1 for _ in correction_fields])
-    header[0].markdown("**馬名**")
-    for i, f in enumerate(correction_fields):
-        header[i+1].markdown(f"**{f}**")
-
-    for idx, row in df.iterrows():
-        cols = st.columns([1] + [1 for _ in correction_fields])
-        cols[0].markdown(row["馬名"])
-        for i, (field, max_val) in enumerate(correction_fields.items()):
-            val = cols[i+1].selectbox(
-                "",
-                options=[round(x, 2) for x in [-max_val, -max_val/2, 0.0, max_val/2, max_val]],
-                index=2,
-                key=f"{row['馬名']}_{field}"
-            )
-            corrections[field + "補正"].append(val)
-
-    for key, values in corrections.items():
-        df[key] = pd.to_numeric(values, errors='coerce')
-
-    df["補正スコア"] = df[[f + "補正" for f in correction_fields]].sum(axis=1)
-    df["総合スコア"] = df["人気スコア"] * 0.5 + df["複勝率スコア"] * 0.3 + df["補正スコア"] * 0.2
-    df["確率"] = normalize(df["総合スコア"])
+    with st.form("corr_form"):
+        st.markdown("### 補正入力表")
+        header = st.columns([1] + [1 for _ in correction_fields])
+        header[0].markdown("**馬名**")
+        for i, f in enumerate(correction_fields):
+            header[i+1].markdown(f"**{f}**")
+
+        options_by_field = {
+            field: [round(x, 2) for x in [-max_val, -max_val/2, 0.0, max_val/2, max_val]]
+            for field, max_val in correction_fields.items()
+        }
+        names = df["馬名"].tolist()
+        for name in names:
+            cols = st.columns([1] + [1 for _ in correction_fields])
+            cols[0].markdown(name)
+            for i, field in enumerate(correction_fields):
+                val = cols[i+1].selectbox(
+                    "",
+                    options=options_by_field[field],
+                    index=2,
+                    key=f"{name}_{field}"
+                )
+                corrections[field + "補正"].append(val)
+        submitted = st.form_submit_button("計算")
+
+    # 補正はまとめて送信し、初回の送信までは以降の計算を行わない
+    # 送信済みフラグはアップロード内容ごとに持つ（別のCSVに差し替えたら再送信が必要）
+    data_key = (race_file.file_id, rate_file.file_id)
+    if submitted:
+        st.session_state["corr_submitted_for"] = data_key
+    if st.session_state.get("corr_submitted_for") != data_key:
+        st.info("補正を入力して『計算』を押してください。")
+        st.stop()
+
+    corr_cols = [f + "補正" for f in correction_fields]
+    corr_arr = np.asarray([corrections[c] for c in corr_cols], dtype=np.float64).T  # (馬数, 補正項目数)
+    df[corr_cols] = corr_arr
+
+    df["補正スコア"] = corr_arr.sum(axis=1)
+    pop = df["人気スコア"].to_numpy(dtype=np.float64)
+    rate = df["複勝率スコア"].to_numpy(dtype=np.float64)
+    corr = df["補正スコア"].to_numpy(dtype=np.float64)
+    df["総合スコア"], df["確率"] = fuse_scores(pop, rate, corr)
 
     # 期待値計算
     if "単勝" in ticket_types:
@@ -115,13 +173,14 @@ if race_file and rate_file:
 
     # 期待値表示
     st.subheader("④ 期待値表示（黄色 = 閾値以上）")
+
+    def highlight(s):
+        return np.where(s.to_numpy() >= threshold, "background-color: yellow", "")
+
     for t in ticket_types:
         col = f"{t}期待値"
         if col in df.columns:
-            styled_df = df[["馬名", "単勝オッズ", "確率", col]].style.applymap(
-                lambda v: "background-color: yellow" if isinstance(v, (int, float)) and v >= threshold else "",
-                subset=[col]
-            )
+            styled_df = df[["馬名", "単勝オッズ", "確率", col]].style.apply(highlight, subset=[col])
             st.markdown(f"### {t} 期待値")
             st.dataframe(styled_df)
 
@@ -138,43 +197,49 @@ if race_file and rate_file:
     # オッズ手入力フォーム（任意）
     st.subheader("⑥ 手入力オッズ（単勝・複勝 + 期待値表示）")
     st.markdown("⚠️ 出走表CSVにオッズが無い場合はここで手入力してください")
-    for idx, row in df.iterrows():
-        cols = st.columns([2, 1, 1, 1, 1])
-        cols[0].markdown(f"**{row['馬名']}**")
+    tan_defaults = df["単勝オッズ"].tolist()
+    fuku_defaults = df["複勝オッズ"].tolist() if "複勝オッズ" in df.columns else [0.0] * len(df)
+    probs = df["確率"].tolist()
+    tan_list, fuku_list = [], []
+    with st.form("odds_form"):
+        for idx, name, tan_default, fuku_default, prob in zip(df.index, names, tan_defaults, fuku_defaults, probs):
+            cols = st.columns([2, 1, 1, 1, 1])
+            cols[0].markdown(f"**{name}**")
 
-        tan_input = cols[1].number_input(f"単勝_{row['馬名']}", value=float(row.get("単勝オッズ", 0.0)), step=0.1, key=f"tan_input_{idx}")
-        fuku_input = cols[2].number_input(f"複勝_{row['馬名']}", value=float(row.get("複勝オッズ", 0.0)), step=0.1, key=f"fuku_input_{idx}")
+            tan_input = cols[1].number_input(f"単勝_{name}", value=float(tan_default), step=0.1, key=f"tan_input_{idx}")
+            fuku_input = cols[2].number_input(f"複勝_{name}", value=float(fuku_default), step=0.1, key=f"fuku_input_{idx}")
 
-        df.at[idx, "単勝オッズ"] = tan_input
-        df.at[idx, "複勝オッズ"] = fuku_input
+            tan_list.append(tan_input)
+            fuku_list.append(fuku_input)
 
-        t_exp = tan_input * row["確率"] if tan_input > 0 else 0
-        f_exp = fuku_input * row["確率"] if fuku_input > 0 else 0
+            t_exp = tan_input * prob if tan_input > 0 else 0
+            f_exp = fuku_input * prob if fuku_input > 0 else 0
 
-        cols[3].markdown(f"🟡 単勝期待値: {t_exp:.2f}")
-        cols[4].markdown(f"🟢 複勝期待値: {f_exp:.2f}")
+            cols[3].markdown(f"🟡 単勝期待値: {t_exp:.2f}")
+            cols[4].markdown(f"🟢 複勝期待値: {f_exp:.2f}")
+        st.form_submit_button("期待値を更新")
+
+    df["単勝オッズ"] = tan_list
+    df["複勝オッズ"] = fuku_list
 
 # 馬連・ワイド用の手入力UI
 if "馬連" in ticket_types or "ワイド" in ticket_types:
     st.subheader("⑦ 馬連・ワイド 手入力 + 期待値")
-    horses = df["馬名"].tolist()
-    pairs = list(itertools.combinations(horses, 2))
-
-    for i, (h1, h2) in enumerate(pairs):
+    horses_arr = df["馬名"].to_numpy()
+    prob_arr = df["確率"].to_numpy(dtype=np.float64)
+    i_idx, j_idx = np.triu_indices(len(horses_arr), k=1)
+    h1s = horses_arr[i_idx]
+    h2s = horses_arr[j_idx]
+    pair_prob_arr = 2 * prob_arr[i_idx] * prob_arr[j_idx]  # 簡易合成確率（独立仮定 ×2補正）
+
+    for i, (h1, h2) in enumerate(zip(h1s, h2s)):
         cols = st.columns([2, 1, 1, 1, 1])
         cols[0].markdown(f"**{h1} × {h2}**")
 
         umaren_odds = cols[1].number_input(f"馬連_{h1}_{h2}", min_value=0.0, step=0.1, key=f"umaren_{i}")
         wide_odds = cols[2].number_input(f"ワイド_{h1}_{h2}", min_value=0.0, step=0.1, key=f"wide_{i}")
 
-        # 安全に確率取得（該当がなければ0.0に）
-        prob1 = df[df["馬名"] == h1]["確率"]
-        prob1 = prob1.values[0] if not prob1.empty else 0.0
-
-        prob2 = df[df["馬名"] == h2]["確率"]
-        prob2 = prob2.values[0] if not prob2.empty else 0.0
-
-        pair_prob = prob1 * prob2 * 2  # 簡易合成確率（独立仮定 ×2補正）
+        pair_prob = pair_prob_arr[i]
 
         uma_exp = umaren_odds * pair_prob if umaren_odds > 0 else 0
         wide_exp = wide_odds * pair_prob if wide_odds > 0 else 0